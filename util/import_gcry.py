@@ -20,13 +20,151 @@ import re
 import sys
 import os
 import datetime
-import codecs
+import shutil
+import multiprocessing
+import concurrent.futures
+
+# Patterns used while importing.  Compile them once here rather than on
+# every line of every imported file.
+# Files in cipher/ which are known by name: old ChangeLogs which aren't
+# imported, files we don't need and autogenerated files.  Anything else
+# is imported if it is a C source or header.
+_CIPHER_FILE_KIND = {"ChangeLog" : "changelog",
+                     "ChangeLog-2011" : "changelog",
+                     "Manifest" : "removed",
+                     "Makefile.am" : "removed",
+                     "ac.c" : "removed",
+                     "cipher.c" : "removed",
+                     "hash-common.c" : "removed",
+                     "hmac-tests.c" : "removed",
+                     "md.c" : "removed",
+                     "pubkey.c" : "removed",
+                     "kdf.c" : "removed",
+                     "elgamal.c" : "removed",
+                     "primegen.c" : "removed",
+                     "ecc.c" : "removed",
+                     "test-getrusage.c" : "removed",
+                     "Makefile.in" : "generated"}
+_PAT_CRYPTO_NAME = re.compile (r" *\"([A-Z0-9_a-z]*)\"")
+_PAT_WEAK_KEYS = re.compile (r"(static byte|static unsigned char) (weak_keys_chksum)\[[0-9]*\] =")
+# Functions needed only for selftests or key generation.  These are
+# matched as prefixes of the line following the return type, so e.g.
+# "selftest" also covers selftest_fips and selftests_sha1.
+_SELFTEST_PREFIXES = ("run_selftests", "selftest", "tripledes_set2keys",
+                      "do_tripledes_set_extra_info", "_gcry_rmd160_mixblock",
+                      "serpent_test", "dsa_generate_ext", "test_keys",
+                      "gen_k", "sign", "gen_x931_parm_xp", "generate_x931",
+                      "generate_key", "dsa_generate", "dsa_sign", "ecc_sign",
+                      "generate", "generate_fips186",
+                      "_gcry_register_pk_dsa_progress",
+                      "_gcry_register_pk_ecc_progress", "progress",
+                      "scanval", "ec2os", "ecc_generate_ext", "ecc_generate",
+                      "compute_keygrip", "ecc_get_param", "gen_x931_parm_xi",
+                      "rsa_decrypt", "rsa_sign", "rsa_generate_ext",
+                      "rsa_generate", "secret", "check_exponent",
+                      "rsa_blind", "rsa_unblind", "extract_a_from_sexp",
+                      "curve_free", "curve_copy", "point_set")
+# Cheap first test before looking at the prefixes.
+_SELFTEST_FIRST_CHARS = frozenset ([p[0] for p in _SELFTEST_PREFIXES] + ["_"])
+_PAT_SELFTEST_GCRY = re.compile (r"_gcry_(aes_c.._..c|[a-z0-9]*_hash_buffer)")
+# Replacements emitted for removed functions which are still referenced.
+_STUBS = (("serpent_test",
+           "static const char *serpent_test (void) { return 0; }\n"),
+          ("dsa_generate", "#define dsa_generate 0"),
+          ("ecc_generate", "#define ecc_generate 0"),
+          ("rsa_generate ", "#define rsa_generate 0"),
+          ("rsa_sign", "#define rsa_sign 0"),
+          ("rsa_decrypt", "#define rsa_decrypt 0"),
+          ("dsa_sign", "#define dsa_sign 0"),
+          ("ecc_sign", "#define ecc_sign 0"))
+# First characters of the lines import_cipher_file looks for after the
+# selftest handling: "#include", "gcry_*_spec_t", "static ...", "void",
+# "cipher_extra_spec_t", "pk_extra_spec_t" and "md_extra_spec_t".
+_DECL_FIRST_CHARS = frozenset ("#cgmpsv")
+_PAT_IDENT = re.compile (r"[a-zA-Z0-9_]*")
+_PAT_INCLUDE = re.compile (r"# *include <(.*)>")
+# Line ends with a ";", as in a declaration.
+_STATEMENT_END = (";", ";\n")
+_PAT_FUNC_TYPE = re.compile (r"(static const char( |)\*|static gpg_err_code_t|void|static int|static gcry_err_code_t|static gcry_mpi_t|static void|void|static elliptic_curve_t) *$")
+_PAT_MPI_FUNC_TYPE = re.compile (r"(const char( |)\*|void) *$")
+
+# Generated sources are up to a few hundred KiB; use a buffer big enough
+# to hold them rather than the default 8 KiB one.
+_WRITE_BUFSIZE = 1024 * 1024
+
+def open_output (path):
+    return open (path, "w", encoding="utf-8", buffering=_WRITE_BUFSIZE,
+                 newline="\n")
+
+# Entries of directory PATH other than subdirectories, sorted by name.
+def list_files (path):
+    with os.scandir (path) as it:
+        return sorted ([e for e in it if not e.is_dir ()],
+                       key=lambda e: e.name)
+
+def read_file (path):
+    f = open (path, "r", encoding="utf-8", newline="")
+    data = f.read ()
+    f.close ()
+    return data
+
+# Whether PATH already holds exactly DATA (bytes).
+def unchanged (path, data):
+    try:
+        f = open (path, "rb")
+    except OSError:
+        return False
+    old = f.read ()
+    f.close ()
+    return old == data
+
+# With --keep-unchanged, outputs whose content would stay the same are
+# not rewritten, so their timestamps don't trigger rebuilds.
+def write_file (path, parts):
+    data = "".join (parts)
+    if keep_unchanged and unchanged (path, data.encode ("utf-8")):
+        return
+    fw = open_output (path)
+    fw.write (data)
+    fw.close ()
+
+def write_bytes (path, data):
+    if keep_unchanged and unchanged (path, data):
+        return
+    fw = open (path, "wb")
+    fw.write (data)
+    fw.close ()
+
+# ChangeLog entry describing the changes made to one imported file.
+class ChangeLogEntry:
+    def __init__ (self, fname):
+        self.parts = ["	* %s" % fname]
+        self.changed = False
+
+    @property
+    def text (self):
+        return "".join (self.parts)
+
+    def add (self, msg, sep = " "):
+        if self.changed:
+            self.parts.append ("\n	")
+        else:
+            self.parts.append (sep)
+            self.changed = True
+        self.parts.append (msg)
+
+    def removed (self, fname):
+        self.add ("(%s): Removed." % fname)
+
+    def removed_decl (self, fname):
+        self.add ("(%s): Removed declaration." % fname)
 
 if len (sys.argv) < 3:
-    print ("Usage: %s SOURCE DESTINATION" % sys.argv[0])
+    print ("Usage: %s SOURCE DESTINATION [--keep-unchanged]" % sys.argv[0])
     exit (0)
 indir = sys.argv[1]
 outdir = sys.argv[2]
+keep_unchanged = "--keep-unchanged" in sys.argv[3:]
 
 basedir = os.path.join (outdir, "lib/libgcrypt-grub")
 try:
@@ -52,17 +190,18 @@ except:
     print ("WARNING: %s already exists" % srcdir)
 
 cipher_files = sorted (os.listdir (cipher_dir_in))
-conf = codecs.open (os.path.join ("grub-core", "Makefile.gcry.def"), "w", "utf-8")
-conf.write ("AutoGen definitions Makefile.tpl;\n\n")
-confutil = codecs.open ("Makefile.utilgcry.def", "w", "utf-8")
-confutil.write ("AutoGen definitions Makefile.tpl;\n\n")
-confutil.write ("library = {\n");
-confutil.write ("  name = libgrubgcry.a;\n");
-confutil.write ("  cflags = '$(CFLAGS_GCRY)';\n");
-confutil.write ("  cppflags = '$(CPPFLAGS_GCRY)';\n");
-confutil.write ("  extra_dist = grub-core/lib/libgcrypt-grub/cipher/ChangeLog;\n");
-confutil.write ("\n");
-chlog = ""
+# Output is accumulated in lists and written out in one go.
+conf = []
+conf.append ("AutoGen definitions Makefile.tpl;\n\n")
+confutil = []
+confutil.append ("AutoGen definitions Makefile.tpl;\n\n")
+confutil.append ("library = {\n");
+confutil.append ("  name = libgrubgcry.a;\n");
+confutil.append ("  cflags = '$(CFLAGS_GCRY)';\n");
+confutil.append ("  cppflags = '$(CPPFLAGS_GCRY)';\n");
+confutil.append ("  extra_dist = grub-core/lib/libgcrypt-grub/cipher/ChangeLog;\n");
+confutil.append ("\n");
+chlog = []
 modules_sym_md = []
 
 # Strictly speaking CRC32/CRC24 work on bytes so this value should be 1
@@ -84,56 +223,69 @@ mdblocksizes = {"_gcry_digest_spec_crc32" : 64,
                 "_gcry_digest_spec_tiger2" : 64,
                 "_gcry_digest_spec_whirlpool" : 64}
 
-cryptolist = codecs.open (os.path.join (cipher_dir_out, "crypto.lst"), "w", "utf-8")
+cryptolist = []
 
 # rijndael is the only cipher using aliases. So no need for mangling, just
 # hardcode it
-cryptolist.write ("RIJNDAEL: gcry_rijndael\n");
-cryptolist.write ("RIJNDAEL192: gcry_rijndael\n");
-cryptolist.write ("RIJNDAEL256: gcry_rijndael\n");
-cryptolist.write ("AES128: gcry_rijndael\n");
-cryptolist.write ("AES-128: gcry_rijndael\n");
-cryptolist.write ("AES-192: gcry_rijndael\n");
-cryptolist.write ("AES-256: gcry_rijndael\n");
-
-cryptolist.write ("ADLER32: adler32\n");
-cryptolist.write ("CRC64: crc64\n");
-
-for cipher_file in cipher_files:
+cryptolist.append ("RIJNDAEL: gcry_rijndael\n");
+cryptolist.append ("RIJNDAEL192: gcry_rijndael\n");
+cryptolist.append ("RIJNDAEL256: gcry_rijndael\n");
+cryptolist.append ("AES128: gcry_rijndael\n");
+cryptolist.append ("AES-128: gcry_rijndael\n");
+cryptolist.append ("AES-192: gcry_rijndael\n");
+cryptolist.append ("AES-256: gcry_rijndael\n");
+
+cryptolist.append ("ADLER32: adler32\n");
+cryptolist.append ("CRC64: crc64\n");
+
+# What importing one file from cipher/ contributes to the shared output.
+class ImportedFile:
+    def __init__ (self):
+        self.chlog = ""
+        self.cryptolist = []
+        self.conf = ""
+        self.confutil = ""
+        self.sym_md = None
+
+def import_cipher_file (cipher_file):
+    res = ImportedFile ()
     infile = os.path.join (cipher_dir_in, cipher_file)
     outfile = os.path.join (cipher_dir_out, cipher_file)
-    if cipher_file == "ChangeLog" or cipher_file == "ChangeLog-2011":
-        continue
-    chlognew = "	* %s" % cipher_file
-    if re.match ("(Manifest|Makefile\.am|ac\.c|cipher\.c|hash-common\.c|hmac-tests\.c|md\.c|pubkey\.c)$", cipher_file) or cipher_file == "kdf.c" or cipher_file == "elgamal.c" or cipher_file == "primegen.c" or cipher_file == "ecc.c" or cipher_file == "test-getrusage.c":
-        chlog = "%s%s: Removed\n" % (chlog, chlognew)
-        continue
+    kind = _CIPHER_FILE_KIND.get (cipher_file)
+    if kind is None and cipher_file.endswith ((".c", ".h")):
+        kind = "source"
+    if kind == "changelog":
+        return res
+    chentry = ChangeLogEntry (cipher_file)
+    if kind == "removed":
+        res.chlog = "%s: Removed\n" % chentry.text
+        return res
     # Autogenerated files. Not even worth mentionning in ChangeLog
-    if re.match ("Makefile\.in$", cipher_file):
-        continue
-    nch = False
-    if re.match (".*\.[ch]$", cipher_file):
-        isc = re.match (".*\.c$", cipher_file)
-        f = codecs.open (infile, "r", "utf-8")
-        fw = codecs.open (outfile, "w", "utf-8")
-        fw.write ("/* This file was automatically imported with \n")
-        fw.write ("   import_gcry.py. Please don't modify it */\n")
-        fw.write ("#include <grub/dl.h>\n")
+    if kind == "generated":
+        return res
+    if kind == "source":
+        isc = cipher_file.endswith (".c")
+        data = read_file (infile)
+        out = []
+        write = out.append
+        write ("/* This file was automatically imported with \n")
+        write ("   import_gcry.py. Please don't modify it */\n")
+        write ("#include <grub/dl.h>\n")
         if cipher_file == "camellia.h":
-            fw.write ("#include <grub/misc.h>\n")
-            fw.write ("void camellia_setup128(const unsigned char *key, grub_uint32_t *subkey);\n")
-            fw.write ("void camellia_setup192(const unsigned char *key, grub_uint32_t *subkey);\n")
-            fw.write ("void camellia_setup256(const unsigned char *key, grub_uint32_t *subkey);\n")
-            fw.write ("void camellia_encrypt128(const grub_uint32_t *subkey, grub_uint32_t *io);\n")
-            fw.write ("void camellia_encrypt192(const grub_uint32_t *subkey, grub_uint32_t *io);\n")                      
-            fw.write ("void camellia_encrypt256(const grub_uint32_t *subkey, grub_uint32_t *io);\n")                      
-            fw.write ("void camellia_decrypt128(const grub_uint32_t *subkey, grub_uint32_t *io);\n")
-            fw.write ("void camellia_decrypt192(const grub_uint32_t *subkey, grub_uint32_t *io);\n")                      
-            fw.write ("void camellia_decrypt256(const grub_uint32_t *subkey, grub_uint32_t *io);\n")                      
-            fw.write ("#define memcpy grub_memcpy\n")
+            write ("#include <grub/misc.h>\n")
+            write ("void camellia_setup128(const unsigned char *key, grub_uint32_t *subkey);\n")
+            write ("void camellia_setup192(const unsigned char *key, grub_uint32_t *subkey);\n")
+            write ("void camellia_setup256(const unsigned char *key, grub_uint32_t *subkey);\n")
+            write ("void camellia_encrypt128(const grub_uint32_t *subkey, grub_uint32_t *io);\n")
+            write ("void camellia_encrypt192(const grub_uint32_t *subkey, grub_uint32_t *io);\n")                      
+            write ("void camellia_encrypt256(const grub_uint32_t *subkey, grub_uint32_t *io);\n")                      
+            write ("void camellia_decrypt128(const grub_uint32_t *subkey, grub_uint32_t *io);\n")
+            write ("void camellia_decrypt192(const grub_uint32_t *subkey, grub_uint32_t *io);\n")                      
+            write ("void camellia_decrypt256(const grub_uint32_t *subkey, grub_uint32_t *io);\n")                      
+            write ("#define memcpy grub_memcpy\n")
         # Whole libgcrypt is distributed under GPLv3+ or compatible
         if isc:
-            fw.write ("GRUB_MOD_LICENSE (\"GPLv3+\");\n")
+            write ("GRUB_MOD_LICENSE (\"GPLv3+\");\n")
 
         ciphernames = []
         mdnames = []
@@ -152,29 +304,33 @@ for cipher_file in cipher_files:
         skip_statement = False
         if isc:
             modname = cipher_file [0:len(cipher_file) - 2]
-            if re.match (".*-glue$", modname):
+            if modname.endswith ("-glue"):
                 modname = modname.replace ("-glue", "")
                 isglue = True
             modname = "gcry_%s" % modname
-        for line in f:
-            line = line
+            # Appended to every spec struct in this file.
+            modname_block = ("#ifdef GRUB_UTIL\n"
+                             "    .modname = \"%s\",\n"
+                             "#endif\n" % modname)
+        for line in data.splitlines (True):
             if skip_statement:
-                if not re.search (";", line) is None:
+                if ";" in line:
                     skip_statement = False
                 continue
             if skip > 0:
                 if line[0] == "}":
                     skip = skip - 1
                 continue
+            ends_struct = "};" in line
             if skip2:
-                if not re.search (" *};", line) is None:
+                if ends_struct:
                     skip2 = False
                 continue
             if iscryptostart:
-                s = re.search (" *\"([A-Z0-9_a-z]*)\"", line)
-                if not s is None:
+                s = _PAT_CRYPTO_NAME.search (line)
+                if s:
                     sg = s.groups()[0]
-                    cryptolist.write (("%s: %s\n") % (sg, modname))
+                    res.cryptolist.append (("%s: %s\n") % (sg, modname))
                     iscryptostart = False
             if ismd:
                 spl = line.split (",")
@@ -182,244 +338,159 @@ for cipher_file in cipher_files:
                     mdctxsizes.append (spl[9-mdarg].lstrip ().rstrip())
                 mdarg = mdarg + len (spl) - 1
             if ismd or iscipher or ispk:
-                if not re.search (" *};", line) is None:
+                if ends_struct:
                     if not iscomma:
-                        fw.write ("    ,\n")
-                    fw.write ("#ifdef GRUB_UTIL\n");
-                    fw.write ("    .modname = \"%s\",\n" % modname);
-                    fw.write ("#endif\n");
+                        write ("    ,\n")
+                    write (modname_block)
                     if ismd:
                         if not (mdname in mdblocksizes):
                             print ("ERROR: Unknown digest blocksize: %s\n"
                                    % mdname)
                             exit (1)
-                        fw.write ("    .blocksize = %s\n"
-                                  % mdblocksizes [mdname])
+                        write ("    .blocksize = %s\n"
+                               % mdblocksizes [mdname])
                     ismd = False
                     mdarg = 0
                     iscipher = False
                     ispk = False
-                iscomma = not re.search (",$", line) is None
+                iscomma = line.rstrip ().endswith (",")
             # Used only for selftests.
-            m = re.match ("(static byte|static unsigned char) (weak_keys_chksum)\[[0-9]*\] =", line)
-            if not m is None:
+            m = _PAT_WEAK_KEYS.match (line)
+            if m:
                 skip = 1
                 fname = m.groups ()[1]
-                chmsg = "(%s): Removed." % fname
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+                chentry.removed (fname)
                 continue
             if hold:
                 hold = False
                 # We're optimising for size and exclude anything needing good
                 # randomness.
-                if not re.match ("(run_selftests|selftest|_gcry_aes_c.._..c|_gcry_[a-z0-9]*_hash_buffer|tripledes_set2keys|do_tripledes_set_extra_info|_gcry_rmd160_mixblock|serpent_test|dsa_generate_ext|test_keys|gen_k|sign|gen_x931_parm_xp|generate_x931|generate_key|dsa_generate|dsa_sign|ecc_sign|generate|generate_fips186|_gcry_register_pk_dsa_progress|_gcry_register_pk_ecc_progress|progress|scanval|ec2os|ecc_generate_ext|ecc_generate|compute_keygrip|ecc_get_param|_gcry_register_pk_dsa_progress|gen_x931_parm_xp|gen_x931_parm_xi|rsa_decrypt|rsa_sign|rsa_generate_ext|rsa_generate|secret|check_exponent|rsa_blind|rsa_unblind|extract_a_from_sexp|curve_free|curve_copy|point_set)", line) is None:
+                if line[:1] in _SELFTEST_FIRST_CHARS \
+                   and (line.startswith (_SELFTEST_PREFIXES)
+                        or (line.startswith ("_gcry_")
+                            and _PAT_SELFTEST_GCRY.match (line))):
 
                     skip = 1
-                    if not re.match ("selftest", line) is None and cipher_file == "idea.c":
+                    if line.startswith ("selftest") and cipher_file == "idea.c":
                         skip = 3
 
-                    if not re.match ("serpent_test", line) is None:
-                        fw.write ("static const char *serpent_test (void) { return 0; }\n");
-                    if not re.match ("dsa_generate", line) is None:
-                        fw.write ("#define dsa_generate 0");
-                    if not re.match ("ecc_generate", line) is None:
-                        fw.write ("#define ecc_generate 0");
-                    if not re.match ("rsa_generate ", line) is None:
-                        fw.write ("#define rsa_generate 0");
-                    if not re.match ("rsa_sign", line) is None:
-                        fw.write ("#define rsa_sign 0");
-                    if not re.match ("rsa_decrypt", line) is None:
-                        fw.write ("#define rsa_decrypt 0");
-                    if not re.match ("dsa_sign", line) is None:
-                        fw.write ("#define dsa_sign 0");
-                    if not re.match ("ecc_sign", line) is None:
-                        fw.write ("#define ecc_sign 0");
-                    fname = re.match ("[a-zA-Z0-9_]*", line).group ()
-                    chmsg = "(%s): Removed." % fname
-                    if nch:
-                        chlognew = "%s\n	%s" % (chlognew, chmsg)
-                    else:
-                        chlognew = "%s %s" % (chlognew, chmsg)
-                        nch = True                        
+                    for prefix, stub in _STUBS:
+                        if line.startswith (prefix):
+                            write (stub)
+                    fname = _PAT_IDENT.match (line).group ()
+                    chentry.removed (fname)
                     continue
                 else:
-                    fw.write (holdline)
-            m = re.match ("# *include <(.*)>", line)
-            if not m is None:
-                chmsg = "Removed including of %s" % m.groups ()[0]
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s: %s" % (chlognew, chmsg)
-                    nch = True
+                    write (holdline)
+            # The remaining checks all look for top-level declarations and
+            # directives starting with one of these characters.  Pass
+            # anything else (indented code, comments, braces) through.
+            if not line[:1] in _DECL_FIRST_CHARS:
+                write (line)
+                continue
+            m = _PAT_INCLUDE.match (line)
+            if m:
+                chentry.add ("Removed including of %s" % m.groups ()[0], ": ")
                 continue
-            m = re.match ("gcry_cipher_spec_t", line)
-            if isc and not m is None:
+            if isc and line.startswith ("gcry_cipher_spec_t"):
                 assert (not ismd)
                 assert (not ispk)
                 assert (not iscipher)
                 assert (not iscryptostart)
                 ciphername = line [len ("gcry_cipher_spec_t"):].strip ()
-                ciphername = re.match("[a-zA-Z0-9_]*",ciphername).group ()
+                ciphername = _PAT_IDENT.match (ciphername).group ()
                 ciphernames.append (ciphername)
                 iscipher = True
                 iscryptostart = True
 
-            m = re.match ("gcry_pk_spec_t", line)
-            if isc and not m is None:
+            if isc and line.startswith ("gcry_pk_spec_t"):
                 assert (not ismd)
                 assert (not ispk)
                 assert (not iscipher)
                 assert (not iscryptostart)
                 pkname = line [len ("gcry_pk_spec_t"):].strip ()
-                pkname = re.match("[a-zA-Z0-9_]*",pkname).group ()
+                pkname = _PAT_IDENT.match (pkname).group ()
                 pknames.append (pkname)
                 ispk = True
                 iscryptostart = True
 
-            m = re.match ("gcry_md_spec_t", line)
-            if isc and not m is None:
+            if isc and line.startswith ("gcry_md_spec_t"):
                 assert (not ismd)
                 assert (not ispk)
                 assert (not iscipher)
                 assert (not iscryptostart)
                 mdname = line [len ("gcry_md_spec_t"):].strip ()
-                mdname = re.match("[a-zA-Z0-9_]*",mdname).group ()
+                mdname = _PAT_IDENT.match (mdname).group ()
                 mdnames.append (mdname)
                 ismd = True
                 mdarg = 0
                 iscryptostart = True
-            m = re.match ("static const char \*selftest.*;$", line)
-            if not m is None:
+            if line.startswith ("static const char *selftest") \
+               and line.endswith (_STATEMENT_END):
                 fname = line[len ("static const char \*"):]
-                fname = re.match ("[a-zA-Z0-9_]*", fname).group ()
-                chmsg = "(%s): Removed declaration." % fname
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+                fname = _PAT_IDENT.match (fname).group ()
+                chentry.removed_decl (fname)
                 continue
-            m = re.match ("static gcry_mpi_t gen_k .*;$", line)
-            if not m is None:
-                chmsg = "(gen_k): Removed declaration."
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+            if line.startswith ("static gcry_mpi_t gen_k ") \
+               and line.endswith (_STATEMENT_END):
+                chentry.removed_decl ("gen_k")
                 continue
-            m = re.match ("static (int|void) test_keys .*;$", line)
-            if not m is None:
-                chmsg = "(test_keys): Removed declaration."
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+            if line.startswith (("static int test_keys ",
+                                 "static void test_keys ")) \
+               and line.endswith (_STATEMENT_END):
+                chentry.removed_decl ("test_keys")
                 continue
-            m = re.match ("static void secret .*;$", line)
-            if not m is None:
-                chmsg = "(secret): Removed declaration."
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+            if line.startswith ("static void secret ") \
+               and line.endswith (_STATEMENT_END):
+                chentry.removed_decl ("secret")
                 continue
-            m = re.match ("static void \(\*progress_cb\).*;$", line)
-            if not m is None:
-                chmsg = "(progress_cb): Removed declaration."
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+            if line.startswith ("static void (*progress_cb)") \
+               and line.endswith (_STATEMENT_END):
+                chentry.removed_decl ("progress_cb")
                 continue
-            m = re.match ("static void \*progress_cb_data.*;$", line)
-            if not m is None:
-                chmsg = "(progress_cb): Removed declaration."
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+            if line.startswith ("static void *progress_cb_data") \
+               and line.endswith (_STATEMENT_END):
+                chentry.removed_decl ("progress_cb")
                 continue
 
-            m = re.match ("(static const char( |)\*|static gpg_err_code_t|void|static int|static gcry_err_code_t|static gcry_mpi_t|static void|void|static elliptic_curve_t) *$", line)
-            if not m is None:
+            if _PAT_FUNC_TYPE.match (line):
                 hold = True
                 holdline = line
                 continue
-            m = re.match ("static int tripledes_set2keys \(.*\);", line)
-            if not m is None:
-                continue
-            m = re.match ("static int tripledes_set3keys \(.*\);", line)
-            if not m is None:
-                continue
-            m = re.match ("static int tripledes_set2keys \(", line)
-            if not m is None:
-                skip_statement = True
+            if line.startswith (("static int tripledes_set2keys (",
+                                 "static int tripledes_set3keys (")):
+                # Drop declarations right away, definitions up to the
+                # end of the statement.
+                if not ");" in line:
+                    skip_statement = True
                 continue
-            m = re.match ("static int tripledes_set3keys \(", line)
-            if not m is None:
-                skip_statement = True
-                continue
-            m = re.match ("static const char sample_secret_key", line)
-            if not m is None:
-                skip_statement = True
-                continue
-            m = re.match ("static const char sample_public_key", line)
-            if not m is None:
-                skip_statement = True
-                continue
-            m = re.match ("static void sign|static gpg_err_code_t sign|static gpg_err_code_t generate",
-                          line)
-            if not m is None:
+            if line.startswith (("static const char sample_secret_key",
+                                 "static const char sample_public_key",
+                                 "static void sign",
+                                 "static gpg_err_code_t sign",
+                                 "static gpg_err_code_t generate")):
                 skip_statement = True
                 continue
 
-            m = re.match ("cipher_extra_spec_t", line)
-            if isc and not m is None:
+            if isc and line.startswith ("cipher_extra_spec_t"):
                 skip2 = True
                 fname = line[len ("cipher_extra_spec_t "):]
-                fname = re.match ("[a-zA-Z0-9_]*", fname).group ()
-                chmsg = "(%s): Removed." % fname
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+                fname = _PAT_IDENT.match (fname).group ()
+                chentry.removed (fname)
                 continue
-            m = re.match ("pk_extra_spec_t", line)
-            if isc and not m is None:
+            if isc and line.startswith ("pk_extra_spec_t"):
                 skip2 = True
                 fname = line[len ("pk_extra_spec_t "):]
-                fname = re.match ("[a-zA-Z0-9_]*", fname).group ()
-                chmsg = "(%s): Removed." % fname
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+                fname = _PAT_IDENT.match (fname).group ()
+                chentry.removed (fname)
                 continue
-            m = re.match ("md_extra_spec_t", line)
-            if isc and not m is None:
+            if isc and line.startswith ("md_extra_spec_t"):
                 skip2 = True
                 fname = line[len ("md_extra_spec_t "):]
-                fname = re.match ("[a-zA-Z0-9_]*", fname).group ()
-                chmsg = "(%s): Removed." % fname
-                if nch:
-                    chlognew = "%s\n	%s" % (chlognew, chmsg)
-                else:
-                    chlognew = "%s %s" % (chlognew, chmsg)
-                    nch = True
+                fname = _PAT_IDENT.match (fname).group ()
+                chentry.removed (fname)
                 continue
-            fw.write (line)
+            write (line)
         if len (ciphernames) > 0 or len (mdnames) > 0 or len (pknames) > 0:
             if isglue:
                 modfiles = "lib/libgcrypt-grub/cipher/%s lib/libgcrypt-grub/cipher/%s" \
@@ -427,82 +498,98 @@ for cipher_file in cipher_files:
             else:
                 modfiles = "lib/libgcrypt-grub/cipher/%s" % cipher_file
             if len (ciphernames) > 0 or len (mdnames) > 0:
-                modules_sym_md.append (modname)
-            chmsg = "(GRUB_MOD_INIT(%s)): New function\n" % modname
-            if nch:
-                chlognew = "%s\n	%s" % (chlognew, chmsg)
-            else:
-                chlognew = "%s%s" % (chlognew, chmsg)
-                nch = True
-            fw.write ("\n\nGRUB_MOD_INIT(%s)\n" % modname)
-            fw.write ("{\n")
+                res.sym_md = modname
+            chentry.add ("(GRUB_MOD_INIT(%s)): New function\n" % modname, "")
+            write ("\n\nGRUB_MOD_INIT(%s)\n" % modname)
+            write ("{\n")
             for ciphername in ciphernames:
-                chmsg = "Register cipher %s" % ciphername
-                chlognew = "%s\n	%s" % (chlognew, chmsg)
-                fw.write ("  grub_cipher_register (&%s);\n" % ciphername)
+                chentry.add ("Register cipher %s" % ciphername)
+                write ("  grub_cipher_register (&%s);\n" % ciphername)
             for ctxsize in mdctxsizes:
-                fw.write ("  COMPILE_TIME_ASSERT(%s <= GRUB_CRYPTO_MAX_MD_CONTEXT_SIZE);\n" % ctxsize)
+                write ("  COMPILE_TIME_ASSERT(%s <= GRUB_CRYPTO_MAX_MD_CONTEXT_SIZE);\n" % ctxsize)
             for mdname in mdnames:
-                chmsg = "Register digest %s" % mdname
-                chlognew = "%s\n	%s" % (chlognew, chmsg)
-                fw.write ("  grub_md_register (&%s);\n" % mdname)
+                chentry.add ("Register digest %s" % mdname)
+                write ("  grub_md_register (&%s);\n" % mdname)
             for pkname in pknames:
-                chmsg = "Register pk %s" % mdname
-                chlognew = "%s\n	%s" % (chlognew, chmsg)
-                fw.write ("  grub_crypto_pk_%s = &%s;\n"
-                          % (pkname.replace ("_gcry_pubkey_spec_", ""), pkname))
-            fw.write ("}")
-            chmsg = "(GRUB_MOD_FINI(%s)): New function\n" % modname
-            chlognew = "%s\n	%s" % (chlognew, chmsg)
-            fw.write ("\n\nGRUB_MOD_FINI(%s)\n" % modname)
-            fw.write ("{\n")
+                chentry.add ("Register pk %s" % pkname)
+                write ("  grub_crypto_pk_%s = &%s;\n"
+                       % (pkname.replace ("_gcry_pubkey_spec_", ""), pkname))
+            write ("}")
+            chentry.add ("(GRUB_MOD_FINI(%s)): New function\n" % modname)
+            write ("\n\nGRUB_MOD_FINI(%s)\n" % modname)
+            write ("{\n")
             for ciphername in ciphernames:
-                chmsg = "Unregister cipher %s" % ciphername
-                chlognew = "%s\n	%s" % (chlognew, chmsg)
-                fw.write ("  grub_cipher_unregister (&%s);\n" % ciphername)
+                chentry.add ("Unregister cipher %s" % ciphername)
+                write ("  grub_cipher_unregister (&%s);\n" % ciphername)
             for mdname in mdnames:
-                chmsg = "Unregister MD %s" % mdname
-                chlognew = "%s\n	%s" % (chlognew, chmsg)
-                fw.write ("  grub_md_unregister (&%s);\n" % mdname)
+                chentry.add ("Unregister MD %s" % mdname)
+                write ("  grub_md_unregister (&%s);\n" % mdname)
             for pkname in pknames:
-                chmsg = "Unregister pk %s" % mdname
-                chlognew = "%s\n	%s" % (chlognew, chmsg)
-                fw.write ("  grub_crypto_pk_%s = 0;\n"
-                          % (pkname.replace ("_gcry_pubkey_spec_", "")))
-            fw.write ("}\n")
-            conf.write ("module = {\n")
-            conf.write ("  name = %s;\n" % modname)
-            for src in modfiles.split():
-                conf.write ("  common = %s;\n" % src)
-                if len (ciphernames) > 0 or len (mdnames) > 0:
-                    confutil.write ("  common = grub-core/%s;\n" % src)
+                chentry.add ("Unregister pk %s" % pkname)
+                write ("  grub_crypto_pk_%s = 0;\n"
+                       % (pkname.replace ("_gcry_pubkey_spec_", "")))
+            write ("}\n")
+            common = "".join (["  common = %s;\n" % src
+                               for src in modfiles.split ()])
+            if len (ciphernames) > 0 or len (mdnames) > 0:
+                res.confutil = "".join (["  common = grub-core/%s;\n" % src
+                                         for src in modfiles.split ()])
+            cflags = "$(CFLAGS_GCRY)"
             if modname == "gcry_ecc":
-                conf.write ("  common = lib/libgcrypt-grub/mpi/ec.c;\n")
-                conf.write ("  cflags = '$(CFLAGS_GCRY) -Wno-redundant-decls -Wno-sign-compare';\n")
+                common = "%s  common = lib/libgcrypt-grub/mpi/ec.c;\n" % common
+                cflags = "$(CFLAGS_GCRY) -Wno-redundant-decls -Wno-sign-compare"
             elif modname == "gcry_rijndael" or modname == "gcry_md4" or modname == "gcry_md5" or modname == "gcry_rmd160" or modname == "gcry_sha1" or modname == "gcry_sha256" or modname == "gcry_sha512" or modname == "gcry_tiger":
                 # Alignment checked by hand
-                conf.write ("  cflags = '$(CFLAGS_GCRY) -Wno-cast-align';\n");
-            else:
-                conf.write ("  cflags = '$(CFLAGS_GCRY)';\n");
-            conf.write ("  cppflags = '$(CPPFLAGS_GCRY)';\n");
-            conf.write ("};\n\n")
-            f.close ()
-            fw.close ()
-            if nch:
-                chlog = "%s%s\n" % (chlog, chlognew)
+                cflags = "$(CFLAGS_GCRY) -Wno-cast-align"
+            res.conf = ("module = {\n"
+                        "  name = %s;\n"
+                        "%s"
+                        "  cflags = '%s';\n"
+                        "  cppflags = '$(CPPFLAGS_GCRY)';\n"
+                        "};\n\n" % (modname, common, cflags))
+            if chentry.changed:
+                res.chlog = "%s\n" % chentry.text
         elif isc and cipher_file != "camellia.c":
             print ("WARNING: C file isn't a module: %s" % cipher_file)
-            f.close ()
-            fw.close ()
-            os.remove (outfile)
-            chlog = "%s\n	* %s: Removed" % (chlog, cipher_file)
-        continue
-    chlog = "%s%sSkipped unknown file\n" % (chlog, chlognew)
+            if os.path.exists (outfile):
+                os.remove (outfile)
+            res.chlog = "\n	* %s: Removed" % cipher_file
+            return res
+        write_file (outfile, out)
+        return res
+    res.chlog = "%sSkipped unknown file\n" % chentry.text
     print ("WARNING: unknown file %s" % cipher_file)
-
-cryptolist.close ()
-
-for src in sorted (os.listdir (os.path.join (indir, "src"))):
+    return res
+
+# Each file in cipher/ is imported independently, so spread them over
+# worker processes.  The workers are forked so that they see the settings
+# computed above; where fork isn't available just import them here.
+if "fork" in multiprocessing.get_all_start_methods () \
+   and (os.cpu_count () or 1) > 1:
+    with concurrent.futures.ProcessPoolExecutor (
+            mp_context=multiprocessing.get_context ("fork")) as executor:
+        results = list (executor.map (import_cipher_file, cipher_files))
+else:
+    results = [import_cipher_file (f) for f in cipher_files]
+
+for res in results:
+    chlog.append (res.chlog)
+    cryptolist.extend (res.cryptolist)
+    conf.append (res.conf)
+    confutil.append (res.confutil)
+    if res.sym_md is not None:
+        modules_sym_md.append (res.sym_md)
+
+
+write_file (os.path.join (cipher_dir_out, "crypto.lst"), cryptolist)
+
+# Files from src/ which need fixing up.  These are plain ASCII
+# substitutions so they are done on the raw bytes.
+src_replacements = {"types.h" : ((b"float f;", b""), (b"double g;", b"")),
+                    "g10lib.h" : ((b"(printf,f,a)", b"(__printf__,f,a)"),)}
+
+for entry in list_files (os.path.join (indir, "src")):
+    src = entry.name
     if src == "versioninfo.rc.in" or src == "ath.c" or src == "ChangeLog-2011" \
             or src == "dumpsexp.c" or src == "fips.c" or src == "gcrypt.h.in" \
             or src == "gcryptrnd.c"or src == "getrandom.c" \
@@ -516,50 +603,38 @@ for src in sorted (os.listdir (os.path.join (indir, "src"))):
             or src == "stdmem.c" or src == "visibility.c":
         continue
     outfile = os.path.join (basedir, "src", src)
-    infile = os.path.join (indir, "src", src)
-    if os.path.isdir (infile):
-        continue
-    fw = codecs.open (outfile, "w", "utf-8")
+    infile = entry.path
     if src == "gcrypt-module.h":
-        fw.close ()
+        write_file (outfile, [])
         continue
     if src == "visibility.h":
-        fw.write ("# include <grub/gcrypt/gcrypt.h>\n")
-        fw.close ()
-        continue
-    f = codecs.open (infile, "r", "utf-8")
-    if src == "types.h":
-        fw.write (f.read ().replace ("float f;", "").replace ("double g;", ""))
-        f.close ()
-        fw.close ()
+        write_file (outfile, ["# include <grub/gcrypt/gcrypt.h>\n"])
         continue
-
-    if src == "g10lib.h":
-        fw.write (f.read ().replace ("(printf,f,a)", "(__printf__,f,a)"))
-        f.close ()
-        fw.close ()
+    if not src in src_replacements and not keep_unchanged:
+        shutil.copyfile (infile, outfile)
         continue
-
-    fw.write (f.read ())
+    f = open (infile, "rb")
+    data = f.read ()
     f.close ()
-    fw.close ()
+    for old, new in src_replacements.get (src, ()):
+        data = data.replace (old, new)
+    write_bytes (outfile, data)
 
-for src in sorted (os.listdir (os.path.join (indir, "mpi"))):
+for entry in list_files (os.path.join (indir, "mpi")):
+    src = entry.name
     if src == "config.links" or src == "ChangeLog-2011" \
             or src == "mpi-scan.c" or src == "Manifest" \
             or src == "Makefile.am":
         continue
-    infile = os.path.join (indir, "mpi", src)
+    infile = entry.path
     outfile = os.path.join (basedir, "mpi", src)
-    if os.path.isdir (infile):
-        continue
-    f = codecs.open (infile, "r", "utf-8")
-    fw = codecs.open (outfile, "w", "utf-8")
-    fw.write ("/* This file was automatically imported with \n")
-    fw.write ("   import_gcry.py. Please don't modify it */\n")
+    data = read_file (infile)
+    out = ["/* This file was automatically imported with \n",
+           "   import_gcry.py. Please don't modify it */\n"]
+    write = out.append
     hold = False
     skip = 0
-    for line in f:
+    for line in data.splitlines (True):
         if skip > 0:
             if line[0] == "}":
                 skip = skip - 1
@@ -568,92 +643,78 @@ for src in sorted (os.listdir (os.path.join (indir, "mpi"))):
             hold = False
             # We're optimising for size and exclude anything needing good
             # randomness.
-            if not re.match ("(_gcry_mpi_get_hw_config|gcry_mpi_randomize)", line) is None:
+            if line.startswith (("_gcry_mpi_get_hw_config",
+                                 "gcry_mpi_randomize")):
                 skip = 1
                 continue
             else:
-                fw.write (holdline)
-        m = re.match ("(const char( |)\*|void) *$", line)
-        if not m is None:
+                write (holdline)
+        if _PAT_MPI_FUNC_TYPE.match (line):
             hold = True
             holdline = line
             continue
-        m = re.match ("#include \"mod-source-info\.h\"", line)
-        if not m is None:
+        if line.startswith ("#include \"mod-source-info.h\""):
             continue
-        fw.write (line)
+        write (line)
+    write_file (outfile, out)
 
-chlog = "%s	* crypto.lst: New file.\n" % chlog
+chlog.append ("	* crypto.lst: New file.\n")
 
-outfile = os.path.join (cipher_dir_out, "types.h")
-fw=codecs.open (outfile, "w", "utf-8")
-fw.write ("#include <grub/types.h>\n")
-fw.write ("#include <cipher_wrap.h>\n")
-chlog = "%s	* types.h: New file.\n" % chlog
-fw.close ()
+write_file (os.path.join (cipher_dir_out, "types.h"),
+            ["#include <grub/types.h>\n",
+             "#include <cipher_wrap.h>\n"])
+chlog.append ("	* types.h: New file.\n")
 
-outfile = os.path.join (cipher_dir_out, "memory.h")
-fw=codecs.open (outfile, "w", "utf-8")
-fw.write ("#include <cipher_wrap.h>\n")
-chlog = "%s	* memory.h: New file.\n" % chlog
-fw.close ()
+write_file (os.path.join (cipher_dir_out, "memory.h"),
+            ["#include <cipher_wrap.h>\n"])
+chlog.append ("	* memory.h: New file.\n")
 
+write_file (os.path.join (cipher_dir_out, "cipher.h"),
+            ["#include <grub/crypto.h>\n",
+             "#include <cipher_wrap.h>\n"])
+chlog.append ("	* cipher.h: Likewise.\n")
 
-outfile = os.path.join (cipher_dir_out, "cipher.h")
-fw=codecs.open (outfile, "w", "utf-8")
-fw.write ("#include <grub/crypto.h>\n")
-fw.write ("#include <cipher_wrap.h>\n")
-chlog = "%s	* cipher.h: Likewise.\n" % chlog
-fw.close ()
-
-outfile = os.path.join (cipher_dir_out, "g10lib.h")
-fw=codecs.open (outfile, "w", "utf-8")
-fw.write ("#include <cipher_wrap.h>\n")
-chlog = "%s	* g10lib.h: Likewise.\n" % chlog
-fw.close ()
+write_file (os.path.join (cipher_dir_out, "g10lib.h"),
+            ["#include <cipher_wrap.h>\n"])
+chlog.append ("	* g10lib.h: Likewise.\n")
 
 infile = os.path.join (cipher_dir_in, "ChangeLog")
 outfile = os.path.join (cipher_dir_out, "ChangeLog")
 
-conf.close ();
-
-initfile = codecs.open (os.path.join (cipher_dir_out, "init.c"), "w", "utf-8")
-initfile.write ("#include <grub/crypto.h>\n")
-for module in modules_sym_md:
-    initfile.write ("extern void grub_%s_init (void);\n" % module)
-    initfile.write ("extern void grub_%s_fini (void);\n" % module)
-initfile.write ("\n")
-initfile.write ("void\n")
-initfile.write ("grub_gcry_init_all (void)\n")
-initfile.write ("{\n")
-for module in modules_sym_md:
-    initfile.write ("  grub_%s_init ();\n" % module)
-initfile.write ("}\n")
-initfile.write ("\n")
-initfile.write ("void\n")
-initfile.write ("grub_gcry_fini_all (void)\n")
-initfile.write ("{\n")
-for module in modules_sym_md:
-    initfile.write ("  grub_%s_fini ();\n" % module)
-initfile.write ("}\n")
-initfile.close ()
-
-confutil.write ("  common = grub-core/lib/libgcrypt-grub/cipher/init.c;\n")
-confutil.write ("};\n");
-confutil.close ();
-
-
-f=codecs.open (infile, "r", "utf-8")
-fw=codecs.open (outfile, "w", "utf-8")
+write_file (os.path.join ("grub-core", "Makefile.gcry.def"), conf)
+
+externs = "".join (["extern void grub_%s_init (void);\n"
+                    "extern void grub_%s_fini (void);\n" % (module, module)
+                    for module in modules_sym_md])
+inits = "".join (["  grub_%s_init ();\n" % module for module in modules_sym_md])
+finis = "".join (["  grub_%s_fini ();\n" % module for module in modules_sym_md])
+write_file (os.path.join (cipher_dir_out, "init.c"),
+            ["#include <grub/crypto.h>\n"
+             "%s"
+             "\n"
+             "void\n"
+             "grub_gcry_init_all (void)\n"
+             "{\n"
+             "%s"
+             "}\n"
+             "\n"
+             "void\n"
+             "grub_gcry_fini_all (void)\n"
+             "{\n"
+             "%s"
+             "}\n" % (externs, inits, finis)])
+
+confutil.append ("  common = grub-core/lib/libgcrypt-grub/cipher/init.c;\n")
+confutil.append ("};\n");
+write_file ("Makefile.utilgcry.def", confutil)
+
+
 dt = datetime.date.today ()
-fw.write ("%04d-%02d-%02d  Automatic import tool\n" % \
-          (dt.year,dt.month, dt.day))
-fw.write ("\n")
-fw.write ("	Imported ciphers to GRUB\n")
-fw.write ("\n")
-fw.write (chlog)
-fw.write ("\n")
-for line in f:
-    fw.write (line)
-f.close ()
-fw.close ()
+write_file (outfile, ["%04d-%02d-%02d  Automatic import tool\n" % \
+                      (dt.year,dt.month, dt.day),
+                      "\n",
+                      "	Imported ciphers to GRUB\n",
+                      "\n",
+                      "".join (chlog),
+                      "\n",
+                      read_file (infile)])